@@ -1,8 +1,14 @@
 import serial
-from sys import version_info
+import array
+import ctypes
+import ctypes.util
+import queue
+import select
+import struct
 import threading
 import time
 import sys
+import traceback
 
 try:
     # for Python2
@@ -13,7 +19,25 @@ except ImportError:
     # from tkinter import *
     import tkinter as tk
 
-PY2 = version_info[0] == 2  # Running Python 2.x?
+try:
+    # for Linux, used to put the USB serial port in low latency mode
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = None
+
+try:
+    # libc write() lets command packets skip pyserial's Python level write loop
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.write.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+    libc.write.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    libc = None
+
+# lookup tables indexed by moveType (1 motor, 2 turning, 3 body, 4 headv, 5 headh)
+MOVE_LABELS = (None, "Motor", "Turning", "Body Movement", "Vert. Head Movement", "Horiz. Head Movement")
+MOVE_CHANNELS = (None, 1, 2, 0, 4, 3)  # the servo channel each moveType drives
+NEUTRALIZE_AFTER = (False, True, True, False, False, False)  # return to neutral and rest afterwards
 
 
 #
@@ -42,29 +66,108 @@ class Controller:
     # ports, or you are using a Windows OS, you can provide the tty port.  For
     # example, '/dev/ttyACM2' or for Windows, something like 'COM3'.
     def __init__(self, ttyStr='/dev/ttyACM0', device=0x0c):
-        # Open the command port
-        self.usb = serial.Serial(ttyStr)
+        # Open the command port.  The port is configured before it's opened so DTR and
+        # RTS stay low rather than being raised on open (pyserial's default), which
+        # resets some Maestro firmwares.  Reads/writes are bounded by short timeouts
+        # so a stuck USB endpoint can't hang the caller.
+        self.usb = serial.Serial()
+        self.usb.port = ttyStr
+        self.usb.baudrate = 9600
+        self.usb.timeout = 0.1
+        self.usb.write_timeout = 0.05
+        self.usb.dtr = False
+        self.usb.rts = False
+        try:
+            self.usb.open()
+        except serial.SerialException as e:
+            print("could not open Maestro on " + ttyStr + ": " + str(e))
+            raise
+        self.setLowLatency()
+        # File descriptor for writing packets straight to the port with libc, or None
+        # to always go through pyserial (e.g. on Windows).
+        self.fd = None
+        if libc is not None:
+            try:
+                self.fd = self.usb.fileno()
+            except (AttributeError, IOError, OSError):
+                pass
         # Command lead-in and device number are sent for each Pololu serial command.
-        self.PololuCmd = chr(0xaa) + chr(device)
+        self.PololuCmd = bytes([0xaa, device])
+        self.device = device
+        # Reusable buffer for single channel commands (lead-in, device, command,
+        # channel, lsb, msb), filled in place for each command sent.
+        self.cmdBuf = bytearray(6)
+        # Reusable buffer for the Set Multiple Targets command: 5 header bytes
+        # plus a lsb/msb pair for each of the 24 possible channels.
+        self.multiBuf = bytearray(5 + 2 * 24)
         # Track target position for each servo. The function isMoving() will
         # use the Target vs Current servo position to determine if movement is
         # occuring.  Upto 24 servos on a Maestro, (0-23). Targets start at 0.
         self.Targets = [0] * 24
         # Servo minimum and maximum targets can be restricted to protect components.
-        self.Mins = [0] * 24
-        self.Maxs = [0] * 24
+        # Kept as compact unsigned short arrays since they're read on every setTarget.
+        self.Mins = array.array('H', [0] * 24)
+        self.Maxs = array.array('H', [0] * 24)
+        # Last target actually written for each channel, so repeated targets can
+        # skip the serial write.  setTarget, setTargets and sendPacket all record
+        # what they write here; -1 means unknown and forces the next write.
+        self.lastSent = [-1] * 24
+
+    # Ask the Linux tty driver to deliver small reads immediately by setting
+    # ASYNC_LOW_LATENCY (0x2000) in serial_struct.flags, avoiding the driver's
+    # latency timer on replies such as getPosition.  Silently skipped where the
+    # ioctl isn't supported (Windows, or drivers without TIOCSSERIAL).
+    def setLowLatency(self):
+        # pyserial 3.5+ does the same ioctl itself
+        if hasattr(self.usb, 'set_low_latency_mode'):
+            try:
+                self.usb.set_low_latency_mode(True)
+            except (ValueError, IOError, OSError, NotImplementedError):
+                pass  # NotImplementedError on non-Linux POSIX platforms
+            return
+        if fcntl is None:
+            return
+        try:
+            buf = array.array('i', [0] * 32)
+            fcntl.ioctl(self.usb.fileno(), termios.TIOCGSERIAL, buf)
+            buf[4] |= 0x2000  # flags field
+            fcntl.ioctl(self.usb.fileno(), termios.TIOCSSERIAL, buf)
+        except (AttributeError, IOError, OSError):
+            pass
 
     # Cleanup by closing USB serial port
     def close(self):
+        # stop using the descriptor first; the OS may hand its number to another file
+        self.fd = None
         self.usb.close()
 
+    # Write a packet to the serial port.  Uses libc write() on the port's file
+    # descriptor when possible; ctypes releases the GIL for the call, so the gui
+    # keeps running during a slow USB write.  Anything libc couldn't write (the
+    # port is non-blocking) is finished by pyserial, which honors write_timeout.
+    def write(self, buf):
+        if self.fd is not None:
+            count = len(buf)
+            if isinstance(buf, (bytearray, memoryview)):
+                written = libc.write(self.fd, (ctypes.c_char * count).from_buffer(buf), count)
+            else:
+                written = libc.write(self.fd, buf, count)
+            if written == count:
+                return
+            if written > 0:
+                buf = buf[written:]
+        self.usb.write(buf)
+
     # Send a Pololu command out the serial port
     def sendCmd(self, cmd):
-        cmdStr = self.PololuCmd + cmd
-        if PY2:
-            self.usb.write(cmdStr)
-        else:
-            self.usb.write(bytes(cmdStr, 'latin-1'))
+        self.write(self.PololuCmd + cmd)
+
+    # Fill the reusable command buffer with a channel command and a 14 bit value
+    # split into 7 bit lsb and msb, then send it out the serial port
+    def sendChanCmd(self, cmd, chan, value):
+        struct.pack_into('<BBBBBB', self.cmdBuf, 0, 0xaa, self.device, cmd, chan,
+                         value & 0x7f, (value >> 7) & 0x7f)
+        self.write(self.cmdBuf)
 
     # Set channels min and max value range.  Use this as a safety to protect
     # from accidentally moving outside known safe parameters. A setting of 0
@@ -73,7 +176,10 @@ class Controller:
     # ***Note that the Maestro itself is configured to limit the range of servo travel
     # which has precedence over these values.  Use the Maestro Control Center to configure
     # ranges that are saved to the controller.  Use setRange for software controllable ranges.
+    # Ranges are stored as unsigned 16 bit values, so min and max must be 0 to 65535.
     def setRange(self, chan, min, max):
+        if not (0 <= min <= 0xffff and 0 <= max <= 0xffff):
+            raise ValueError("range must be within 0 to 65535, got " + str(min) + " to " + str(max))
         self.Mins[chan] = min
         self.Maxs[chan] = max
 
@@ -85,6 +191,18 @@ class Controller:
     def getMax(self, chan):
         return self.Maxs[chan]
 
+    # Return target constrained within the channel's Min and Max range, if set
+    def clampTarget(self, chan, target):
+        mn = self.Mins[chan]
+        mx = self.Maxs[chan]
+        # if Min is defined and Target is below, force to Min
+        if mn and target < mn:
+            return mn
+        # if Max is defined and Target is above, force to Max
+        if mx and target > mx:
+            return mx
+        return target
+
     # Set channel to a specified target value.  Servo will begin moving based
     # on Speed and Acceleration parameters previously set.
     # Target values will be constrained within Min and Max range, if set.
@@ -93,19 +211,59 @@ class Controller:
     # Typcially valid servo range is 3000 to 9000 quarter-microseconds
     # If channel is configured for digital output, values < 6000 = Low ouput
     def setTarget(self, chan, target):
-        # if Min is defined and Target is below, force to Min
-        if self.Mins[chan] > 0 and target < self.Mins[chan]:
-            target = self.Mins[chan]
-        # if Max is defined and Target is above, force to Max
-        if self.Maxs[chan] > 0 and target > self.Maxs[chan]:
-            target = self.Maxs[chan]
-        #
-        lsb = target & 0x7f  # 7 bits for least significant byte
-        msb = (target >> 7) & 0x7f  # shift 7 and take next 7 bits for msb
-        cmd = chr(0x04) + chr(chan) + chr(lsb) + chr(msb)
-        self.sendCmd(cmd)
+        target = self.clampTarget(chan, target)
+        # skip the write if the servo was already sent this target
+        if target == self.lastSent[chan]:
+            return
+        self.sendChanCmd(0x04, chan, target)
         # Record Target value
         self.Targets[chan] = target
+        self.lastSent[chan] = target
+
+    # Build a complete Set Target packet for a channel ahead of time, constrained
+    # within the Min and Max range.  Returns (chan, target, packet) to pass to sendPacket.
+    def buildTarget(self, chan, target):
+        target = self.clampTarget(chan, target)
+        return (chan, target, self.PololuCmd + bytes([0x04, chan, target & 0x7f, (target >> 7) & 0x7f]))
+
+    # Send a packet built by buildTarget, recording its target just like setTarget.
+    # Always written, even if the channel was last sent the same target.
+    def sendPacket(self, built):
+        chan, target, pkt = built
+        self.write(pkt)
+        self.Targets[chan] = target
+        self.lastSent[chan] = target
+
+    # Forget the last target sent on a channel so the next setTarget is always written.
+    # Use this when something other than this class may have moved the servo.
+    def invalidateLastSent(self, chan):
+        self.lastSent[chan] = -1
+
+    # Set several contiguous channels, starting at chan, in a single serial packet
+    # using the Set Multiple Targets command (0x1F).  Not available with Micro Maestro.
+    # Each target is constrained within its channel's Min and Max range, if set.
+    def setTargets(self, chan, targets):
+        count = len(targets)
+        changed = False
+        struct.pack_into('<BBBBB', self.multiBuf, 0, 0xaa, self.device, 0x1f, count, chan)
+        for i in range(count):
+            target = self.clampTarget(chan + i, targets[i])
+            struct.pack_into('<BB', self.multiBuf, 5 + 2 * i, target & 0x7f, (target >> 7) & 0x7f)
+            if target != self.lastSent[chan + i]:
+                changed = True
+            self.Targets[chan + i] = target
+            self.lastSent[chan + i] = target
+        # skip the write if every channel was already sent these targets
+        if changed:
+            self.write(memoryview(self.multiBuf)[:5 + 2 * count])
+
+    # Send channels 0-4 back to center (6000) with one Set Multiple Targets packet.
+    # Always written, even if those targets were the last ones sent.
+    # Not available with Micro Maestro.
+    def homeAll(self):
+        for chan in range(5):
+            self.invalidateLastSent(chan)
+        self.setTargets(0, [6000] * 5)
 
     # Set speed of channel
     # Speed is measured as 0.25microseconds/10milliseconds
@@ -113,36 +271,38 @@ class Controller:
     # of 1 will take 1 minute, and a speed of 60 would take 1 second.
     # Speed of 0 is unrestricted.
     def setSpeed(self, chan, speed):
-        lsb = speed & 0x7f  # 7 bits for least significant byte
-        msb = (speed >> 7) & 0x7f  # shift 7 and take next 7 bits for msb
-        cmd = chr(0x07) + chr(chan) + chr(lsb) + chr(msb)
-        self.sendCmd(cmd)
+        self.sendChanCmd(0x07, chan, speed)
 
     # Set acceleration of channel
     # This provide soft starts and finishes when servo moves to target position.
     # Valid values are from 0 to 255. 0=unrestricted, 1 is slowest start.
     # A value of 1 will take the servo about 3s to move between 1ms to 2ms range.
     def setAccel(self, chan, accel):
-        lsb = accel & 0x7f  # 7 bits for least significant byte
-        msb = (accel >> 7) & 0x7f  # shift 7 and take next 7 bits for msb
-        cmd = chr(0x09) + chr(chan) + chr(lsb) + chr(msb)
+        self.sendChanCmd(0x09, chan, accel)
+
+    # Get the current position of the device on the specified channel
+    # The result is returned in a measure of quarter-microseconds, which mirrors
+    # the Target parameter of setTarget.
+    # This is not reading the true servo position, but the last target position sent
+    # to the servo. If the Speed is set to below the top speed of the servo, then
+    # the position result will align well with the acutal servo position, assuming
+    # it is not stalled or slowed.
+    # Returns -1 if the Maestro doesn't reply within 0.1 seconds.
+    def getPosition(self, chan):
+        cmd = bytes([0x10, chan])
         self.sendCmd(cmd)
-
-        # Get the current position of the device on the specified channel
-        # The result is returned in a measure of quarter-microseconds, which mirrors
-        # the Target parameter of setTarget.
-        # This is not reading the true servo position, but the last target position sent
-        # to the servo. If the Speed is set to below the top speed of the servo, then
-        # the position result will align well with the acutal servo position, assuming
-        # it is not stalled or slowed.
-
-
-def getPosition(self, chan):
-    cmd = chr(0x10) + chr(chan)
-    self.sendCmd(cmd)
-    lsb = ord(self.usb.read())
-    msb = ord(self.usb.read())
-    return (msb << 8) + lsb
+        try:
+            fd = self.usb.fileno()
+        except (AttributeError, IOError, OSError):
+            fd = None  # e.g. Windows COM ports, where the port's read timeout applies instead
+        if fd is not None:
+            ready, _, _ = select.select([fd], [], [], 0.1)
+            if not ready:
+                return -1
+        reply = self.usb.read(2)
+        if len(reply) < 2:
+            return -1
+        return struct.unpack_from('<H', reply)[0]  # lsb then msb
 
     # Test to see if a servo has reached the set target position.  This only provides
     # useful results if the Speed parameter is set slower than the maximum speed of
@@ -158,12 +318,16 @@ def getPosition(self, chan):
         return False
 
     # Have all servo outputs reached their targets? This is useful only if Speed and/or
-    # Acceleration have been set on one or more of the channels. Returns True or False.
+    # Acceleration have been set on one or more of the channels. Returns True or False,
+    # or None if the Maestro doesn't reply within 0.1 seconds.
     # Not available with Micro Maestro.
     def getMovingState(self):
-        cmd = chr(0x13)
+        cmd = bytes([0x13])
         self.sendCmd(cmd)
-        if self.usb.read() == chr(0):
+        reply = self.usb.read()
+        if not reply:
+            return None
+        if reply == b'\x00':
             return False
         else:
             return True
@@ -172,19 +336,21 @@ def getPosition(self, chan):
     # have multiple subroutines, which get numbered sequentially from 0 on up. Code your
     # Maestro subroutine to either infinitely loop, or just end (return is not valid).
     def runScriptSub(self, subNumber):
-        cmd = chr(0x27) + chr(subNumber)
+        cmd = bytes([0x27, subNumber])
         # can pass a param with command 0x28
-        # cmd = chr(0x28) + chr(subNumber) + chr(lsb) + chr(msb)
+        # cmd = bytes([0x28, subNumber, lsb, msb])
         self.sendCmd(cmd)
+        # the script can move any servo, so the last sent targets are no longer known
+        for chan in range(24):
+            self.invalidateLastSent(chan)
 
     # Stop the current Maestro Script
     def stopScript(self):
-        cmd = chr(0x24)
+        cmd = bytes([0x24])
         self.sendCmd(cmd)
 
 
 class Gui455:
-    command_list = []  # the list of commands - [moveType, value, time]
 
     # initilizies the main stuff in the class
     def __init__(self, master, contr):
@@ -196,8 +362,31 @@ class Gui455:
         self.step = 32
         self.timeChoice = 1
         self.valCount = 6000
-        self.isRunning = False
+        # set whenever a sequence isn't running; the worker threads wait on it so
+        # pressing stop wakes them immediately instead of after their sleep
+        self.stopped = threading.Event()
+        self.stopped.set()
+        self.runId = 0  # counts runs, so a finished run can't end a newer one
         self.runCount = 0
+        # "Stage = n" text, only rebuilt when runCount changes
+        self.stageText = ""
+        self.lastStage = -1
+        # the queue of up to 8 commands, compiled into (target, neutral target or None,
+        # time) with each target built by Controller.buildTarget; first cmdCount are used
+        self.cmdCount = 0
+        self.compiledCmds = [None] * 8
+
+        # Tk isn't thread safe, so worker threads post canvas updates to this queue
+        # and the main loop applies them in drain_ui
+        self.uiQueue = queue.Queue()
+        self.master.after(40, self.drain_ui)
+
+        # the command and animation threads are started once and wait on these
+        # events for each run, instead of starting new threads every time
+        self.cmdEvent = threading.Event()
+        self.animEvent = threading.Event()
+        self.start_worker(self.cmdEvent, self.command_thread)
+        self.start_worker(self.animEvent, self.animation_thread)
 
         # set up the canvas and add a label to prompt user
         self.myCan = tk.Canvas(master, bg="#333333", width="500", height="250")
@@ -207,6 +396,8 @@ class Gui455:
 
         # adds text info on canvas
         self.curStri = self.myCan.create_text(450, 200, fill="red", anchor="center", text="PROGRAM NOT RUNNING")
+        # stage text is created once and moved/updated in place while running
+        self.curStr = self.myCan.create_text(300, 220, fill="green", anchor="center", text="")
         self.stringCommand = self.myCan.create_text(12, 12, fill="white", anchor="nw", text="Command Queue (max of 8)")
 
         # create 8 string input places to show user in gui
@@ -216,6 +407,14 @@ class Gui455:
             self.step += 20
         self.step = 32
 
+        # the value and time windows are built once and shown again for each command
+        self.dialogResult = tk.IntVar(master)
+        self.dialogVal = 0
+        self.wind, self.valCan, self.valText = self.build_dialog(
+            "Val", "select a value", "value", lambda: self.quit_window1(self.dialogVal))
+        self.win, self.timeCan, self.timeText = self.build_dialog(
+            "Time", "select a time", "time", lambda: self.quit_window2(self.dialogVal))
+
         # add buttons to the main gui window
         self.motor_button = tk.Button(master, text="motor", command=lambda: self.button_pressed(1))
         self.motor_button.pack(side=tk.LEFT)
@@ -234,51 +433,51 @@ class Gui455:
         self.run_button = tk.Button(master, text="stop", command=lambda: self.button_pressed(8))
         self.run_button.pack(side=tk.RIGHT)
 
-    # sets up the window that allows users to select a value/speed for robot movement
-    def choose_values_window(self, val):
-        # set up window with values
-        self.wind = tk.Tk()
-        self.wind.title("Val")
-        self.numCan = tk.Canvas(self.wind, bg="#333333", width="100", height="100")
-        self.numCan.pack(side="top", fill="both", expand=True)
-        label1 = tk.Label(self.wind, text="select a value")
+    # builds a value/time selection window once, hidden until choose_values_window
+    # or choose_time_window shows it; done calls doneCommand, closing it cancels
+    def build_dialog(self, title, prompt, inputType, doneCommand):
+        dialog = tk.Toplevel(self.master)
+        dialog.title(title)
+        dialog.withdraw()
+        dialog.protocol("WM_DELETE_WINDOW", lambda: self.dialogResult.set(0))
+        canvas = tk.Canvas(dialog, bg="#333333", width="100", height="100")
+        canvas.pack(side="top", fill="both", expand=True)
+        label1 = tk.Label(dialog, text=prompt)
         label1.pack()
 
         # shows user what they have entered
-        self.curValue = self.numCan.create_text(12, 12, fill="white", anchor="nw",
-                                                text="Current Value = " + str(self.valCount))
-
-        # add buttons to the value selction window
-        self.up_button = tk.Button(self.wind, text="up", command=lambda: self.change_values("up", "value"))
-        self.up_button.pack(side=tk.LEFT)
-        self.down_button = tk.Button(self.wind, text="down", command=lambda: self.change_values("down", "value"))
-        self.down_button.pack(side=tk.LEFT)
-        self.done_button = tk.Button(self.wind, text="done", command=lambda: self.quit_window1(val))
-        self.done_button.pack(side=tk.LEFT)
-        self.wind.mainloop()  # wait for input
+        text = canvas.create_text(12, 12, fill="white", anchor="nw", text="")
+
+        # add buttons to the selection window
+        up_button = tk.Button(dialog, text="up", command=lambda: self.change_values("up", inputType))
+        up_button.pack(side=tk.LEFT)
+        down_button = tk.Button(dialog, text="down", command=lambda: self.change_values("down", inputType))
+        down_button.pack(side=tk.LEFT)
+        done_button = tk.Button(dialog, text="done", command=doneCommand)
+        done_button.pack(side=tk.LEFT)
+        return dialog, canvas, text
+
+    # shows a dialog built by build_dialog and waits until done is pressed or it's closed
+    def run_dialog(self, dialog, canvas, text, currentText):
+        self.numCan = canvas
+        self.curValue = text
+        self.numCan.itemconfig(self.curValue, text=currentText)
+        self.dialogResult.set(-1)
+        dialog.deiconify()
+        dialog.grab_set()
+        self.master.wait_variable(self.dialogResult)  # wait for input
+        dialog.grab_release()
+        dialog.withdraw()
+
+    # sets up the window that allows users to select a value/speed for robot movement
+    def choose_values_window(self, val):
+        self.dialogVal = val
+        self.run_dialog(self.wind, self.valCan, self.valText, "Current Value = " + str(self.valCount))
 
     # sets up the window that allows users to select the time for robot movement
     def choose_time_window(self, val):
-        # set up window with values
-        self.win = tk.Tk()
-        self.win.title("Time")
-        self.numCan = tk.Canvas(self.win, bg="#333333", width="100", height="100")
-        self.numCan.pack(side="top", fill="both", expand=True)
-        label1 = tk.Label(self.win, text="select a time")
-        label1.pack()
-
-        # shows user what they have entered
-        self.curValue = self.numCan.create_text(12, 12, fill="white", anchor="nw",
-                                                text="Current Time = " + str(self.timeChoice))
-
-        # add buttons to the time selection window
-        self.up_button = tk.Button(self.win, text="up", command=lambda: self.change_values("up", "time"))
-        self.up_button.pack(side=tk.LEFT)
-        self.down_button = tk.Button(self.win, text="down", command=lambda: self.change_values("down", "time"))
-        self.down_button.pack(side=tk.LEFT)
-        self.done_button = tk.Button(self.win, text="done", command=lambda: self.quit_window2(val))
-        self.done_button.pack(side=tk.LEFT)
-        self.win.mainloop()
+        self.dialogVal = val
+        self.run_dialog(self.win, self.timeCan, self.timeText, "Current Time = " + str(self.timeChoice))
 
     # alters the values that the user selects and displays them
     def change_values(self, val, inputType):
@@ -301,152 +500,174 @@ class Gui455:
 
     # quick hack to differentiate the first window from second window closing
     def quit_window1(self, val):
-        self.wind.quit()
-        self.wind.destroy()
+        self.dialogResult.set(1)
 
     # sets values that were input by user into the list and displays text showing so
     def quit_window2(self, val):
-        self.command_list.append([val, self.valCount, self.timeChoice])
-        wordType = ""
-        currPlace = len(self.command_list)
+        # only moveTypes 1-5 have a channel to drive
+        if (not 0 < val < len(MOVE_CHANNELS)):
+            print("error")
+            self.dialogResult.set(0)
+            return
+
+        # build the serial packets now so the command thread only has to send them
+        chan = MOVE_CHANNELS[val]
+        neutral = None
+        if (NEUTRALIZE_AFTER[val]):  # motor and turning
+            neutral = self.contr.buildTarget(chan, 6000)
+        self.compiledCmds[self.cmdCount] = (self.contr.buildTarget(chan, self.valCount), neutral, self.timeChoice)
+        self.cmdCount += 1
+        currPlace = self.cmdCount
 
         # figure out which word to show user
-        if (val == 1):
-            wordType = "Motor"
-        elif (val == 2):
-            wordType = "Turning"
-        elif (val == 3):
-            wordType = "Body Movement"
-        elif (val == 4):
-            wordType = "Vert. Head Movement"
-        elif (val == 5):
-            wordType = "Horiz. Head Movement"
-        else:
-            wordType = "error"
+        wordType = MOVE_LABELS[val]
 
         # shows user what they input in the right position
         self.myCan.itemconfig(self.stringName[currPlace], text=str(currPlace) + ". > " + wordType + ", Value = " + str(
             self.valCount) + ", Time Allowed = " + str(self.timeChoice))
 
-        # reset and destroy
-        self.win.quit()
-        self.win.destroy()
+        # hide the window again
+        self.dialogResult.set(1)
+
+    # queues a Tk call from a worker thread to be run on the main thread
+    def post_ui(self, func, *args, **kwargs):
+        self.uiQueue.put((func, args, kwargs))
+
+    # runs on the main thread, applying queued canvas updates and rescheduling itself
+    def drain_ui(self):
+        # rescheduled first so a queued call that raises can't stop later updates
+        self.master.after(40, self.drain_ui)
+        for i in range(50):
+            try:
+                func, args, kwargs = self.uiQueue.get_nowait()
+            except queue.Empty:
+                break
+            func(*args, **kwargs)
+
+    # starts a daemon thread that runs body each time event is set
+    def start_worker(self, event, body):
+        def worker():
+            while True:
+                event.wait()
+                event.clear()
+                # log and carry on so one failed run doesn't kill the thread for good
+                try:
+                    body()
+                except Exception:
+                    traceback.print_exc()
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True  # don't keep the program alive after the gui closes
+        thread.start()
 
     # Calls the threads and sets values for when program is running
     def execute_threads(self, val):
         self.pos_x = 300
         self.pos_y = 220
-        self.myCan.itemconfig(self.curStri, text="")
-        self.curStri = self.myCan.create_text(450, 200, fill="green", anchor="center", text="PROGRAM RUNNING")
-        self.curStr = self.myCan.create_text(self.pos_x, self.pos_y, fill="green", anchor="center",
-                                             text="Stage = " + str(self.runCount))
-        self.isRunning = True
-        threading.Thread(target=self.animation_thread).start()
-        threading.Thread(target=self.command_thread).start()
+        self.myCan.itemconfig(self.curStri, fill="green", text="PROGRAM RUNNING")
+        self.myCan.coords(self.curStr, self.pos_x, self.pos_y)
+        self.myCan.itemconfig(self.curStr, fill="green", text="Stage = " + str(self.runCount))
+        self.runId += 1
+        self.stopped.clear()
+        self.animEvent.set()
+        self.cmdEvent.set()
+
+    # sleeps until the given time.monotonic() deadline, or until stopped, and returns
+    # the deadline, yielding once to other threads if it has already passed
+    def sleep_until(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            self.stopped.wait(remaining)
+        else:
+            time.sleep(0)
+        return deadline
 
     # runs the thread that controls robot movement
     def command_thread(self):
-        neutralPos = 6000
-
-        # loops through the command list extracting values and calls the controller methods
-        for i in range(len(self.command_list)):
-            if (not self.isRunning):
-                break  # terminates thread if isRunning = false
-
-            self.runCount += 1
-            moveType = self.command_list[i][0]
-            valueGiven = self.command_list[i][1]
-            timeAllowed = self.command_list[i][2]
-            if (moveType == 1):  # motor
-                cont.setTarget(1, valueGiven)
-                time.sleep(timeAllowed)
-                self.contr.setTarget(1, neutralPos)
-                time.sleep(1)  # makes the robot rest after moving to prevent violent jerking
-
-            elif (moveType == 2):  # turning
-                self.contr.setTarget(2, valueGiven)
-                time.sleep(timeAllowed)
-                cont.setTarget(2, neutralPos)
-                time.sleep(1)
-
-            elif (moveType == 3):  # body
-                self.contr.setTarget(0, valueGiven)
-                time.sleep(timeAllowed)
-
-            elif (moveType == 4):  # headv
-                print("turn head")
-                self.contr.setTarget(4, valueGiven)
-                time.sleep(timeAllowed)
-
-            elif (moveType == 5):  # headh
-                self.contr.setTarget(3, valueGiven)
-                time.sleep(timeAllowed)
-            else:
-                print("error")
-        self.isRunning = False
-        self.endMethod()
+        runId = self.runId
+        # each wait is measured from the previous deadline so sleep overshoot doesn't add up
+        deadline = time.monotonic()
+
+        # copied so endMethod resetting cmdCount on stop can't change it under us
+        cmds = self.compiledCmds[:self.cmdCount]
+
+        # finish_run is always queued, even if a serial write raises, so the gui
+        # doesn't stay stuck showing the run
+        try:
+            # loops through the compiled commands sending each packet and waiting its time
+            for i in range(len(cmds)):
+                if (self.stopped.is_set()):
+                    break  # terminates thread if stop was pressed
+
+                self.runCount += 1
+                target, neutral, timeAllowed = cmds[i]
+                self.contr.sendPacket(target)
+                deadline = self.sleep_until(deadline + timeAllowed)
+                if (neutral is not None and not self.stopped.is_set()):
+                    self.contr.sendPacket(neutral)
+                    deadline = self.sleep_until(deadline + 1)  # makes the robot rest after moving to prevent violent jerking
+        finally:
+            # the run stays marked as running until endMethod has cleaned up on the main thread
+            self.post_ui(self.finish_run, runId)
+
+    # runs on the main thread once the command thread is done with a run, ending it
+    # unless stop was already pressed or a newer run has started since
+    def finish_run(self, runId):
+        if (runId == self.runId and not self.stopped.is_set()):
+            self.endMethod()
+
+    # returns the "Stage = n" text for the current runCount, reusing the last string
+    # until the command thread moves on to the next stage
+    def stage_text(self):
+        if (self.runCount != self.lastStage):
+            self.stageText = "Stage = " + str(self.runCount)
+            self.lastStage = self.runCount
+        return self.stageText
 
     # the method that the animation thread runs in the background
     def animation_thread(self):
-        color_value = ""
+        colors = ("green", "aqua")  # text flashes between these, aqua on odd steps
 
         # ensures the program is running for the animation to occur
-        while (self.isRunning):
+        while (not self.stopped.is_set()):
 
             # text flashes, moves back and forth and changes stage number
             for i in range(1, 7):
-                if (not self.isRunning):
-                    break
-                if (i % 2 == 0):
-                    color_value = "green"
-                else:
-                    color_value = "aqua"
-                time.sleep(0.4)
+                if (self.stopped.wait(0.4)):
+                    break  # returns as soon as stop is pressed
                 self.pos_x += 60
-                self.myCan.itemconfig(self.curStr, text="")
-                self.curStr = self.myCan.create_text(self.pos_x, self.pos_y, fill=color_value, anchor="center",
-                                                     text="Stage = " + str(self.runCount))
+                self.post_ui(self.myCan.coords, self.curStr, self.pos_x, self.pos_y)
+                self.post_ui(self.myCan.itemconfig, self.curStr, fill=colors[i & 1], text=self.stage_text())
 
             for i in range(1, 7):
-                if (not self.isRunning):
-                    break
-                if (i % 2 == 0):
-                    color_value = "green"
-                else:
-                    color_value = "aqua"
-                time.sleep(0.4)
+                if (self.stopped.wait(0.4)):
+                    break  # returns as soon as stop is pressed
                 self.pos_x -= 60
-                self.myCan.itemconfig(self.curStr, text="")
-                self.curStr = self.myCan.create_text(self.pos_x, self.pos_y, fill=color_value, anchor="center",
-                                                     text="Stage = " + str(self.runCount))
+                self.post_ui(self.myCan.coords, self.curStr, self.pos_x, self.pos_y)
+                self.post_ui(self.myCan.itemconfig, self.curStr, fill=colors[i & 1], text=self.stage_text())
 
-            self.myCan.itemconfig(self.curStr, text="")
+            self.post_ui(self.myCan.itemconfig, self.curStr, text="")
 
     # called when the running sequence is over or stop was pressed
     def endMethod(self):
         # stop threads
-        self.isRunning == False
+        self.stopped.set()
         # reset text animations
-        self.myCan.itemconfig(self.curStri, text="")
-        self.curStri = self.myCan.create_text(450, 200, fill="red", anchor="center", text="PROGRAM NOT RUNNING")
+        self.myCan.itemconfig(self.curStri, fill="red", text="PROGRAM NOT RUNNING")
         self.myCan.itemconfig(self.curStr, text="")
         # reset robot to original positions
-        self.contr.setTarget(0, 6000)
-        self.contr.setTarget(1, 6000)
-        self.contr.setTarget(2, 6000)
-        self.contr.setTarget(3, 6000)
-        self.contr.setTarget(4, 6000)
+        self.contr.homeAll()
         # reset values
-        for i in range(len(self.command_list)):
+        for i in range(self.cmdCount):
             self.myCan.itemconfig(self.stringName[i + 1], text=str(i + 1) + ".")
 
         self.runCount = 0
-        self.command_list[:] = []
+        self.cmdCount = 0
 
     # called when a button in the main gui is pressed and reacts accordingly
     def button_pressed(self, val):
         # logic statements for robot movement and user input
-        if (len(self.command_list) < 8 and self.isRunning == False):
+        if (self.cmdCount < 8 and self.stopped.is_set()):
             if (val == 1):
                 self.choose_values_window(val)
                 self.choose_time_window(val)
@@ -477,30 +698,30 @@ class Gui455:
 
         # logic statements for delete and run commands
         if (val == 6):
-            if (len(self.command_list) > 0 and self.isRunning == False):
-                self.command_list = self.command_list[:-1]
-                self.myCan.itemconfig(self.stringName[len(self.command_list) + 1],
-                                      text=str(len(self.command_list) + 1) + ".")
+            if (self.cmdCount > 0 and self.stopped.is_set()):
+                self.cmdCount -= 1
+                self.myCan.itemconfig(self.stringName[self.cmdCount + 1],
+                                      text=str(self.cmdCount + 1) + ".")
                 self.step -= 20
                 print("delete pressed")
             else:
                 print("Invalid, enter a command first")
 
         if (val == 7):
-            if (len(self.command_list) > 0 and self.isRunning == False):
+            if (self.cmdCount > 0 and self.stopped.is_set()):
                 self.execute_threads(val)
                 print("run pressed")
             else:
                 print("Invalid, enter a command first")
-        if (val == 8 and self.isRunning == True):
-            self.isRunning = False
+        if (val == 8 and not self.stopped.is_set()):
+            self.stopped.set()
             self.endMethod()
             print("stopped pressed")
 
         # resets user input values
         self.valCount = 6000
         self.timeChoice = 1
-        print(self.command_list)
+        print(self.compiledCmds[:self.cmdCount])
 
 
 # beginning of program